@@ -3,11 +3,270 @@ Create a focused sample EXCLUDING category 90 (miscellaneous/catch-all)
 Focus on specific, well-defined traffic sign categories
 """
 import json
+import errno
+import io
 import os
 import shutil
+import sys
 from pathlib import Path
-import random
-from collections import Counter, defaultdict
+from array import array
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import ijson
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # optional, stdlib json is used instead
+    orjson = None
+
+try:
+    from tqdm import tqdm
+except ImportError:  # optional, progress falls back to plain prints
+    tqdm = None
+
+
+def _iter_items(input_json, prefix):
+    """
+    Stream the objects under one ijson prefix (e.g. 'annotations.item')
+    
+    The objects are built by the C backend, one at a time, so memory stays
+    proportional to one item rather than to the whole file.
+    """
+    with open(input_json, 'rb') as f:
+        yield from ijson.items(f, prefix, use_float=True)
+
+
+# Small top-level sections copied as-is into the sampled dataset
+_SECTIONS = ('categories', 'info', 'licenses')
+
+
+def _scan_coco(input_json):
+    """
+    Collect image ids, (image_id, category_id) annotation pairs and the small
+    categories/info/licenses sections in one pass
+    
+    Works on the raw parse events (floats as float, not Decimal), so no image
+    or annotation dict, nor its bbox/segmentation lists, is ever built. The
+    per-event loop runs about as fast as the two ijson.items passes an id
+    projection would need, and it picks up the small sections without extra
+    scans of the file.
+    Returns three int64 buffers (image ids, annotation image ids, annotation
+    category ids) and a dict of the sections found.
+    """
+    image_ids = array('q')
+    ann_image_ids = array('q')
+    ann_category_ids = array('q')
+    sections = {}
+    builder = section = None
+    image_id = category_id = None
+    with open(input_json, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == section and event in ('end_map', 'end_array'):
+                    sections[section] = builder.value
+                    builder = None
+            elif prefix == 'annotations.item.image_id':
+                image_id = value
+            elif prefix == 'annotations.item.category_id':
+                category_id = value
+            elif prefix == 'annotations.item' and event == 'end_map':
+                ann_image_ids.append(image_id)
+                ann_category_ids.append(category_id)
+                image_id = category_id = None
+            elif prefix == 'images.item.id':
+                image_ids.append(value)
+            elif prefix in _SECTIONS and event in ('start_map', 'start_array'):
+                section = prefix
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+    return image_ids, ann_image_ids, ann_category_ids, sections
+
+
+LINK_MODES = ('copy', 'hardlink', 'reflink', 'auto')
+
+# Errors from os.link that mean "hardlinks are not possible here", not a real failure
+_LINK_FALLBACK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP}
+
+
+def _reflink(src, dst):
+    """
+    Clone src to dst copy-on-write (Btrfs/XFS via FICLONE, APFS via clonefile)
+    """
+    if sys.platform == 'darwin':
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), str(dst))
+        return
+    
+    import fcntl
+    FICLONE = 0x40049409
+    # 'xb' so a leftover dst (possibly hardlinked to src) is never truncated;
+    # _place unlinks it and retries
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError as e:
+            fdst.close()
+            os.unlink(dst)
+            raise OSError(e.errno, f"Cannot reflink {src}: {e.strerror}", str(dst)) from e
+
+
+def _check_reflink(src, images_output):
+    """Fail early, before any output is written, if src cannot be reflinked into images_output"""
+    probe = images_output / f'.reflink-probe-{os.getpid()}'
+    _place(src, probe, _reflink)
+    os.unlink(probe)
+
+
+def _place(src, dst, link_fn):
+    """Run link_fn(src, dst), replacing dst if it is left over from a previous run"""
+    try:
+        link_fn(src, dst)
+    except FileExistsError:
+        os.unlink(dst)
+        link_fn(src, dst)
+
+
+# Copy with os.sendfile relative to an already-open output directory fd.
+# Linux only: macOS sendfile() can only write to sockets.
+_USE_SENDFILE = sys.platform.startswith('linux') and os.open in os.supports_dir_fd
+
+
+def _sendfile_copy(src, name, dir_fd):
+    """
+    Copy src to name inside the directory opened as dir_fd, in-kernel
+    
+    Opening relative to dir_fd resolves only the file name, not the whole
+    output path, for every image. A leftover name is unlinked rather than
+    truncated: after a hardlink run it shares its inode with src.
+    """
+    src_fd = os.open(src, os.O_RDONLY)
+    try:
+        size = os.fstat(src_fd).st_size
+        try:
+            os.unlink(name, dir_fd=dir_fd)
+        except FileNotFoundError:
+            pass
+        dst_fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666, dir_fd=dir_fd)
+        try:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dst_fd, src_fd, offset, size - offset)
+                if sent == 0:
+                    raise OSError(errno.EIO, f"Short copy ({offset} of {size} bytes)", str(src))
+                offset += sent
+        finally:
+            os.close(dst_fd)
+    finally:
+        os.close(src_fd)
+
+
+def _fill_category_mask(image_ids, sorter, positions, ann_image_ids, ann_category_ids,
+                        cat_to_col, n_cols):
+    """
+    Build the images x top-categories byte matrix from annotation id arrays
+    
+    positions are the searchsorted positions of ann_image_ids in image_ids
+    (through sorter). Annotations outside the top categories (cat_to_col == -1)
+    or pointing at unknown images are skipped.
+    """
+    mask = np.zeros((len(image_ids), n_cols), dtype=np.uint8)
+    ann_cols = cat_to_col[ann_category_ids]
+    keep = (ann_cols >= 0) & (positions < len(image_ids))
+    ann_rows = sorter[positions[keep]]
+    ann_cols = ann_cols[keep]
+    known = image_ids[ann_rows] == ann_image_ids[keep]
+    mask[ann_rows[known], ann_cols[known]] = 1
+    return mask
+
+
+def _copy_one(img, source_paths, images_output, link_mode='copy', dir_fd=None):
+    """
+    Copy a single image into the output directory
+    
+    source_paths maps file names to paths from one os.scandir() of the input
+    directory, so no per-image stat is needed. Only the bytes are copied,
+    which skips the permission/timestamp syscalls of copy2: with dir_fd (the
+    open output directory) via os.sendfile, otherwise via shutil.copyfile.
+    
+    link_mode 'hardlink' and 'reflink' avoid duplicating the bytes at all;
+    'auto' tries a hardlink and falls back to a copy across filesystems.
+    
+    Returns (file_name, status) where status is 'copied' or 'missing'.
+    """
+    src = source_paths.get(img['file_name'])
+    if src is None:
+        return img['file_name'], 'missing'
+    dst = images_output / img['file_name']
+    
+    def copy_bytes():
+        if dir_fd is not None:
+            _sendfile_copy(src, img['file_name'], dir_fd)
+        else:
+            shutil.copyfile(src, dst)
+    
+    if link_mode == 'hardlink':
+        _place(src, dst, os.link)
+    elif link_mode == 'reflink':
+        _place(src, dst, _reflink)
+    elif link_mode == 'auto':
+        try:
+            _place(src, dst, os.link)
+        except OSError as e:
+            if e.errno not in _LINK_FALLBACK_ERRNOS:
+                raise
+            copy_bytes()
+    else:
+        copy_bytes()
+    return img['file_name'], 'copied'
+
+
+def _print_progress(done, total):
+    """Default progress callback: one line every 100 images"""
+    if done % 100 == 0 or done == total:
+        print(f"  Processed {done}/{total} images...")
+
+
+def _write_json(obj, path, pretty=False):
+    """
+    Write obj as UTF-8 JSON, compact unless pretty is set
+    
+    Uses orjson when it is installed, otherwise the stdlib encoder.
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        with open(path, 'wb', buffering=1 << 20) as f:
+            f.write(orjson.dumps(obj, option=option))
+        return
+    
+    with open(path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        if pretty:
+            json.dump(obj, f, ensure_ascii=False, indent=2)
+        else:
+            json.dump(obj, f, ensure_ascii=False, separators=(',', ':'))
+
+
+def _write_jsonl(items, path):
+    """
+    Write one compact JSON object per line (NDJSON), so consumers can
+    stream the file a record at a time
+    """
+    if orjson is not None:
+        with open(path, 'wb', buffering=1 << 20) as f:
+            f.writelines(orjson.dumps(item) + b'\n' for item in items)
+        return
+    
+    with open(path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.writelines(
+            json.dumps(item, ensure_ascii=False, separators=(',', ':')) + '\n'
+            for item in items
+        )
+
 
 def create_focused_sample_no_cat90(
     input_json, 
@@ -15,7 +274,11 @@ def create_focused_sample_no_cat90(
     output_dir, 
     top_n_categories=15,
     images_per_category=150,
-    seed=42
+    seed=42,
+    copy_workers=None,
+    link_mode='copy',
+    pretty=False,
+    progress=None
 ):
     """
     Create a sample focusing on specific categories, EXCLUDING category 90
@@ -27,111 +290,173 @@ def create_focused_sample_no_cat90(
         top_n_categories: Number of top categories to focus on (excluding cat 90)
         images_per_category: Target number of images per category
         seed: Random seed for reproducibility
+        copy_workers: Threads used to copy images (default: min(32, 4 * CPUs));
+            raise for network filesystems, lower for a single spinning disk
+        link_mode: How images are placed in the output: 'copy' (default),
+            'hardlink', 'reflink' (copy-on-write clone) or 'auto' (hardlink,
+            falling back to a copy when the output is on another filesystem)
+        pretty: Indent annotations.json for reading; compact by default
+        progress: Copy progress reporting - a callable(done, total), True for a
+            tqdm bar (plain prints without tqdm), False for none. None (default)
+            shows a tqdm bar only when stderr is a terminal
     """
-    random.seed(seed)
+    if link_mode not in LINK_MODES:
+        raise ValueError(f"link_mode must be one of {LINK_MODES}, got {link_mode!r}")
+    
+    rng = np.random.default_rng(seed)
     
     print("=" * 70)
     print("CREATING FOCUSED SAMPLE (EXCLUDING CATEGORY 90)")
     print("=" * 70)
     
-    # Load original data
+    # Stream the original data - only (image_id, category_id) pairs are kept,
+    # packed into int64 buffers so bbox/segmentation payloads are never held in memory
     print("\nLoading dataset...")
-    with open(input_json, 'r') as f:
-        data = json.load(f)
+    image_ids, ann_image_ids, ann_category_ids, sections = _scan_coco(input_json)
+    ann_image_ids = np.frombuffer(ann_image_ids, dtype=np.int64)
+    ann_category_ids = np.frombuffer(ann_category_ids, dtype=np.int64)
     
-    print(f"Total images: {len(data['images'])}")
-    print(f"Total annotations: {len(data['annotations'])}")
+    print(f"Total images: {len(image_ids)}")
+    print(f"Total annotations: {len(ann_category_ids)}")
     
     # Get category counts EXCLUDING category 90
-    category_counts = Counter(
-        ann['category_id'] for ann in data['annotations'] 
-        if ann['category_id'] != 90
-    )
+    not_cat_90 = ann_category_ids != 90
+    category_counts = np.bincount(ann_category_ids[not_cat_90])
     
-    cat_90_count = sum(1 for ann in data['annotations'] if ann['category_id'] == 90)
+    cat_90_count = len(ann_category_ids) - int(not_cat_90.sum())
     print(f"\nExcluding category 90: {cat_90_count:,} annotations removed")
-    print(f"Remaining annotations: {sum(category_counts.values()):,}")
-    
-    # Get top categories (excluding cat 90)
-    top_categories = [cat_id for cat_id, _ in category_counts.most_common(top_n_categories)]
+    print(f"Remaining annotations: {int(category_counts.sum()):,}")
+    
+    # Get top categories (excluding cat 90), most frequent first - a partial
+    # selection finds the cut-off count so only the candidates get sorted
+    present = np.flatnonzero(category_counts)
+    present_counts = category_counts[present]
+    k = min(top_n_categories, len(present))
+    if 0 < k < len(present):
+        threshold = np.partition(present_counts, len(present) - k)[len(present) - k]
+        present = present[present_counts >= threshold]
+        present_counts = category_counts[present]
+    order = np.lexsort((present, -present_counts))
+    top_categories = present[order[:k]].tolist()
     
     print(f"\n=== Top {top_n_categories} Categories (Excluding Cat 90) ===")
     for i, cat_id in enumerate(top_categories, 1):
         count = category_counts[cat_id]
         print(f"{i:2d}. Category {cat_id:3d}: {count:6d} annotations")
     
-    # Group images by which top categories they contain (excluding cat 90)
-    image_categories = defaultdict(set)
-    for ann in data['annotations']:
-        if ann['category_id'] in top_categories:
-            image_categories[ann['image_id']].add(ann['category_id'])
+    # Mark which top categories each image contains (excluding cat 90) in an
+    # images x top-categories byte matrix, rows in the order of data['images']
+    image_ids = np.frombuffer(image_ids, dtype=np.int64)
+    sorter = np.argsort(image_ids, kind='stable')
+    positions = np.searchsorted(image_ids, ann_image_ids, sorter=sorter)
+    
+    cat_to_col = np.full(int(ann_category_ids.max(initial=0)) + 1, -1, dtype=np.int64)
+    cat_to_col[top_categories] = np.arange(len(top_categories))
+    category_mask = _fill_category_mask(
+        image_ids, sorter, positions, ann_image_ids, ann_category_ids,
+        cat_to_col, len(top_categories)
+    )
     
     # Filter to only images that have at least one top category
-    eligible_images = [
-        img for img in data['images'] 
-        if img['id'] in image_categories and len(image_categories[img['id']]) > 0
+    eligible_rows = np.flatnonzero(category_mask.any(axis=1))
+    
+    print(f"\nImages containing top categories: {len(eligible_rows)}")
+    
+    # Sample images with iterative stratification (Sechidis et al.): serve the
+    # category with the smallest remaining quota first and prefer images whose
+    # other categories still need images too, so multi-label images are not
+    # over-selected and every quota is met with as few images as possible
+    quota = np.full(len(top_categories), images_per_category, dtype=np.int64)
+    pool_sizes = category_mask.sum(axis=0, dtype=np.int64)
+    available = category_mask.any(axis=1)
+    col_rows = [np.flatnonzero(category_mask[:, col]) for col in range(len(top_categories))]
+    
+    sampled_rows = []
+    while True:
+        active = np.flatnonzero((quota > 0) & (pool_sizes > 0))
+        if not len(active):
+            break
+        # Smallest remaining quota, ties broken by the largest pool
+        col = active[np.lexsort((-pool_sizes[active], quota[active]))[0]]
+        
+        rows = col_rows[col] = col_rows[col][available[col_rows[col]]]
+        scores = category_mask[rows][:, quota > 0].sum(axis=1, dtype=np.int64)
+        best = rows[scores == scores.max()]
+        row = int(best[rng.integers(len(best))])
+        
+        sampled_rows.append(row)
+        available[row] = False
+        row_cats = category_mask[row].astype(bool)
+        quota[row_cats] -= 1
+        pool_sizes[row_cats] -= 1
+    del col_rows, available
+    
+    sampled_rows = np.array(sorted(sampled_rows), dtype=np.int64)
+    sampled_image_ids = set(image_ids[sampled_rows].tolist())
+    
+    # Number of sampled images containing each top category
+    images_with_cat = dict(zip(
+        top_categories, category_mask[sampled_rows].sum(axis=0, dtype=np.int64).tolist()
+    ))
+    
+    # The per-annotation arrays and the category matrix are not needed past
+    # this point - free them before the second pass and the copy phase
+    del ann_image_ids, ann_category_ids, not_cat_90, image_ids, sorter, positions
+    del cat_to_col, category_mask, eligible_rows
+    
+    # Second streaming pass - keep only the sampled images and their annotations,
+    # counting annotations per category in the sample as they go by
+    sampled_annotations = []
+    sampled_category_counts = Counter()
+    cat_90_in_sample = 0
+    for ann in _iter_items(input_json, 'annotations.item'):
+        if ann['image_id'] in sampled_image_ids:
+            # Filter annotations - EXCLUDE category 90
+            cat_id = ann['category_id']
+            if cat_id == 90:
+                cat_90_in_sample += 1
+            else:
+                sampled_annotations.append(ann)
+                sampled_category_counts[cat_id] += 1
+    
+    sampled_images = [
+        img for img in _iter_items(input_json, 'images.item')
+        if img['id'] in sampled_image_ids
     ]
     
-    print(f"\nImages containing top categories: {len(eligible_images)}")
-    
-    # Sample images trying to balance categories
-    category_image_map = defaultdict(list)
-    for img in eligible_images:
-        for cat_id in image_categories[img['id']]:
-            category_image_map[cat_id].append(img)
-    
-    # Sample images per category
-    sampled_image_ids = set()
-    for cat_id in top_categories:
-        available_images = category_image_map[cat_id]
-        sample_size = min(images_per_category, len(available_images))
-        sampled = random.sample(available_images, sample_size)
-        for img in sampled:
-            sampled_image_ids.add(img['id'])
-    
-    sampled_images = [img for img in data['images'] if img['id'] in sampled_image_ids]
-    
     print(f"\n=== Sampling Strategy ===")
     print(f"Target images per category: {images_per_category}")
     print(f"Total unique images sampled: {len(sampled_images)}")
     
-    # Filter annotations - EXCLUDE category 90
-    sampled_annotations = [
-        ann for ann in data['annotations'] 
-        if ann['image_id'] in sampled_image_ids and ann['category_id'] != 90
-    ]
-    
-    # Count annotations per category in sample
-    sampled_category_counts = Counter(ann['category_id'] for ann in sampled_annotations)
-    
     print(f"Total annotations (excluding cat 90): {len(sampled_annotations)}")
     print(f"\n=== Sampled Category Distribution ===")
-    for cat_id in top_categories:
+    # Format the per-category lines once - printed here and reused for category_info.txt
+    distribution = io.StringIO()
+    write = distribution.write
+    for i, cat_id in enumerate(top_categories, 1):
         count = sampled_category_counts[cat_id]
-        images_with_cat = len([img for img in sampled_images if cat_id in image_categories[img['id']]])
-        print(f"Category {cat_id:3d}: {count:5d} annotations in {images_with_cat:4d} images")
+        write(f"{i:2d}. Category {cat_id:3d}: {count:5d} annotations in {images_with_cat[cat_id]:4d} images\n")
+    distribution = distribution.getvalue()
+    print(distribution, end='')
     
     # Other categories present (excluding cat 90)
+    top_set = frozenset(top_categories)
     other_categories = sum(
         count for cat_id, count in sampled_category_counts.items() 
-        if cat_id not in top_categories and cat_id != 90
+        if cat_id not in top_set
     )
     print(f"\nOther specific categories: {other_categories} annotations")
     
     # Report how many category 90 annotations were in these images
-    cat_90_in_sample = sum(
-        1 for ann in data['annotations']
-        if ann['image_id'] in sampled_image_ids and ann['category_id'] == 90
-    )
     print(f"Category 90 annotations removed: {cat_90_in_sample}")
     
     # Create new dataset
     sampled_data = {
         'images': sampled_images,
         'annotations': sampled_annotations,
-        'categories': data['categories'],
-        'info': data.get('info', {}),
-        'licenses': data.get('licenses', [])
+        'categories': sections.get('categories', []),
+        'info': sections.get('info', {}),
+        'licenses': sections.get('licenses', [])
     }
     
     # Create output directories
@@ -140,30 +465,72 @@ def create_focused_sample_no_cat90(
     images_output = output_path / 'images'
     images_output.mkdir(exist_ok=True)
     
+    # Index the source directory once instead of stat-ing every image
+    with os.scandir(input_images_dir) as entries:
+        source_paths = {entry.name: entry.path for entry in entries if entry.is_file()}
+    
+    if link_mode == 'reflink':
+        probe_src = next(
+            (source_paths[img['file_name']] for img in sampled_images
+             if img['file_name'] in source_paths),
+            None
+        )
+        if probe_src is not None:
+            _check_reflink(probe_src, images_output)
+    
     # Save JSON
     json_output = output_path / 'annotations.json'
-    with open(json_output, 'w') as f:
-        json.dump(sampled_data, f, indent=2)
+    _write_json(sampled_data, json_output, pretty=pretty)
+    
+    # Also save one annotation per line for streaming consumers
+    jsonl_output = output_path / 'annotations.jsonl'
+    _write_jsonl(sampled_annotations, jsonl_output)
     
     print(f"\n=== Saving Dataset ===")
     print(f"Annotations saved to: {json_output}")
+    print(f"Annotation lines saved to: {jsonl_output}")
     
     # Copy images
     print(f"\nCopying {len(sampled_images)} images...")
     copied = 0
     missing = 0
     
-    for img in sampled_images:
-        src = Path(input_images_dir) / img['file_name']
-        dst = images_output / img['file_name']
-        
-        if src.exists():
-            shutil.copy2(src, dst)
-            copied += 1
-            if copied % 100 == 0:
-                print(f"  Copied {copied}/{len(sampled_images)} images...")
+    if copy_workers is None:
+        copy_workers = min(32, (os.cpu_count() or 1) * 4)
+    
+    # Open the output directory once so each copy only resolves a file name
+    dir_fd = os.open(images_output, os.O_RDONLY | os.O_DIRECTORY) if _USE_SENDFILE else None
+    
+    if progress is None:
+        progress = tqdm is not None and sys.stderr.isatty()
+    bar = None
+    if progress is True:
+        if tqdm is not None:
+            bar = tqdm(total=len(sampled_images), unit='img', desc='Copying')
         else:
-            missing += 1
+            progress = _print_progress
+    callback = progress if callable(progress) else None
+    
+    # Copying is I/O bound and the copy syscalls release the GIL, so threads overlap them
+    try:
+        with ThreadPoolExecutor(max_workers=copy_workers) as executor:
+            for _, status in executor.map(
+                lambda img: _copy_one(img, source_paths, images_output, link_mode, dir_fd),
+                sampled_images
+            ):
+                if status == 'copied':
+                    copied += 1
+                else:
+                    missing += 1
+                if bar is not None:
+                    bar.update()
+                elif callback is not None:
+                    callback(copied + missing, len(sampled_images))
+    finally:
+        if bar is not None:
+            bar.close()
+        if dir_fd is not None:
+            os.close(dir_fd)
     
     print(f"\n=== Summary ===")
     print(f"✓ Copied: {copied} images")
@@ -181,11 +548,7 @@ def create_focused_sample_no_cat90(
         f.write("(Category 90 excluded - it's a miscellaneous catch-all)\n")
         f.write("=" * 70 + "\n\n")
         f.write(f"Top {top_n_categories} Categories:\n\n")
-        for i, cat_id in enumerate(top_categories, 1):
-            count = sampled_category_counts[cat_id]
-            images_with_cat = len([img for img in sampled_images 
-                                  if cat_id in image_categories[img['id']]])
-            f.write(f"{i:2d}. Category {cat_id:3d}: {count:5d} annotations in {images_with_cat:4d} images\n")
+        f.write(distribution)
         f.write(f"\nTotal unique images: {len(sampled_images)}\n")
         f.write(f"Total annotations: {len(sampled_annotations)}\n")
         f.write(f"Category 90 annotations removed: {cat_90_in_sample}\n")